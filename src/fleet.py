@@ -0,0 +1,575 @@
+import sys
+import os
+import hmac
+import json
+import secrets
+import signal
+import socket
+import socketserver
+import subprocess
+import threading
+import argparse
+
+from os import path
+from pathlib import Path
+from time import sleep, time
+from typing import List, Dict, Optional
+
+
+
+class FleetAccount:
+    def __init__(self, county: int, username: str, password: str, jobs_file: str, aspects: List[str]):
+        self.county = county
+        self.username = username
+        self.password = password
+        self.jobs_file = jobs_file
+        self.aspects = aspects
+        self.key = '{}-{}'.format(county, username)
+        self.jobs_modified: Optional[float] = None
+        self.fired_jobs: List[str] = []
+
+    def read_jobs(self) -> str:
+        self.jobs_modified = os.stat(self.jobs_file).st_mtime
+        with open(self.jobs_file) as f:
+            return f.read()
+
+    def jobs_changed(self) -> bool:
+        try:
+            return os.stat(self.jobs_file).st_mtime != self.jobs_modified
+        except OSError:
+            return False
+
+    def to_message(self) -> dict:
+        return {'key': self.key, 'county': self.county, 'username': self.username, 'password': self.password,
+                'aspects': self.aspects, 'fired_jobs': self.fired_jobs}
+
+
+class Lease:
+    def __init__(self, worker_id: str, expires: float):
+        self.worker_id = worker_id
+        self.expires = expires
+
+
+class WorkerState:
+    def __init__(self, worker_id: str, cpus: int, max_browsers: int, connection: socket.socket, wfile):
+        self.worker_id = worker_id
+        self.cpus = max(cpus, 1)
+        self.max_browsers = max_browsers
+        self.connection = connection
+        self.wfile = wfile
+        self.write_lock = threading.Lock()
+        self.load = 0.0
+        self.memory = 0.0
+        self.browsers = 0
+
+    # A worker that stops reading makes the write time out. The connection is then dropped, since a partly
+    # written message cannot be taken back, and the worker reconnects.
+    def send(self, message: dict) -> bool:
+        try:
+            with self.write_lock:
+                self.wfile.write((json.dumps(message) + '\n').encode())
+                self.wfile.flush()
+            return True
+        except OSError:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+
+    def score(self, leased: int) -> float:
+        return max(self.browsers, leased) + self.load / self.cpus + self.memory
+
+
+# Every account is run by at most one worker, which holds a lease on it. Leases are renewed by the worker's
+# heartbeats and, once a lease expires, the account is handed to the connected worker with the lowest score.
+# Workers stop their own bots a little before the coordinator considers the lease expired. Messages are only
+# sent after the lock is released, so a worker that is slow to read cannot hold up the rest of the fleet.
+class Coordinator:
+    def __init__(self, accounts: List[FleetAccount]):
+        self.accounts = {account.key: account for account in accounts}
+        self.workers: Dict[str, WorkerState] = dict()
+        self.leases: Dict[str, Lease] = dict()
+        self.lock = threading.Lock()
+
+    def connect(self, worker: WorkerState):
+        with self.lock:
+            self.workers[worker.worker_id] = worker
+        print('Worker {} connected ({} cpus).'.format(worker.worker_id, worker.cpus))
+
+    def disconnect(self, worker: WorkerState):
+        with self.lock:
+            if self.workers.get(worker.worker_id) is worker:
+                del self.workers[worker.worker_id]
+        print('Worker {} disconnected.'.format(worker.worker_id))
+
+    def heartbeat(self, worker: WorkerState, message: dict):
+        with self.lock:
+            worker.load = float(message['load'])
+            worker.memory = float(message['memory'])
+            worker.browsers = int(message['browsers'])
+
+            renewed = []
+            revoked = []
+            for key in message['accounts']:
+                lease = self.leases.get(key)
+                if lease is not None and lease.worker_id == worker.worker_id:
+                    lease.expires = time() + LEASE_DURATION
+                    renewed.append(key)
+                    if key in message.get('fired_jobs', {}):
+                        self.accounts[key].fired_jobs = list(message['fired_jobs'][key])
+                else:
+                    revoked.append(key)
+
+        worker.send({'type': 'renew', 'accounts': renewed, 'lease': LEASE_DURATION})
+        for key in revoked:
+            worker.send({'type': 'revoke', 'key': key})
+
+    def tick(self):
+        assignments = []
+        updates = []
+        with self.lock:
+            now = time()
+            for key, lease in list(self.leases.items()):
+                if lease.expires < now:
+                    print('Lease of {} on worker {} expired.'.format(key, lease.worker_id))
+                    del self.leases[key]
+
+            for account in self.accounts.values():
+                lease = self.leases.get(account.key)
+                if lease is None:
+                    assignment = self.__assign(account)
+                    if assignment is not None:
+                        assignments.append(assignment)
+                elif account.jobs_changed() and lease.worker_id in self.workers:
+                    try:
+                        updates.append((self.workers[lease.worker_id],
+                                        {'type': 'jobs', 'key': account.key, 'jobs': account.read_jobs()}))
+                    except OSError:
+                        print('Jobs file {} of {} could not be read.'.format(account.jobs_file, account.key))
+
+        for worker, message in updates:
+            worker.send(message)
+
+        for worker, account, lease, message in assignments:
+            if worker.send(message):
+                print('Assigned {} to worker {}.'.format(account.key, worker.worker_id))
+            else:
+                with self.lock:
+                    if self.leases.get(account.key) is lease:
+                        del self.leases[account.key]
+
+    def __assign(self, account: FleetAccount):
+        leased = dict()
+        for lease in self.leases.values():
+            leased[lease.worker_id] = leased.get(lease.worker_id, 0) + 1
+
+        candidates = [worker for worker in self.workers.values()
+                      if worker.max_browsers == 0 or leased.get(worker.worker_id, 0) < worker.max_browsers]
+        if not candidates:
+            return None
+
+        worker = min(candidates, key=lambda w: w.score(leased.get(w.worker_id, 0)))
+        try:
+            jobs = account.read_jobs()
+        except OSError:
+            print('Jobs file {} of {} could not be read.'.format(account.jobs_file, account.key))
+            return None
+
+        lease = Lease(worker.worker_id, time() + LEASE_DURATION)
+        self.leases[account.key] = lease
+        return worker, account, lease, {'type': 'assign', 'account': account.to_message(), 'jobs': jobs,
+                                        'lease': LEASE_DURATION}
+
+
+class CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coordinator: Coordinator = self.server.coordinator
+        worker = None
+        self.connection.settimeout(WORKER_TIMEOUT)
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message['type'] == 'hello' and worker is None:
+                    if not hmac.compare_digest(str(message.get('token', '')).encode(), self.server.token.encode()):
+                        print('Rejected a worker from {} with a wrong token.'.format(self.client_address[0]))
+                        return
+                    worker = WorkerState(message['worker'], int(message['cpus']), int(message['max_browsers']),
+                                         self.connection, self.wfile)
+                    coordinator.connect(worker)
+                elif message['type'] == 'heartbeat' and worker is not None:
+                    coordinator.heartbeat(worker, message)
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            if worker is not None:
+                coordinator.disconnect(worker)
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str, port: int, coordinator: Coordinator, token: str):
+        super().__init__((host, port), CoordinatorRequestHandler)
+        self.coordinator = coordinator
+        self.token = token
+
+
+
+class BotProcess:
+    def __init__(self, key: str, directory: str):
+        self.key = key
+        self.directory = directory
+        self.lease_file = path.join(directory, LEASE_FILE_NAME)
+        self.process: Optional[subprocess.Popen] = None
+        self.lease_expires = 0.0
+        self.exited = 0.0
+
+    # The bot reads its lease from the file and ends itself once it expires, so it never outlives a worker
+    # that died without stopping it.
+    def renew(self, lease: float):
+        self.lease_expires = time() + lease - LEASE_SAFETY_MARGIN
+        temporary = self.lease_file + '.tmp'
+        with open(temporary, mode='w') as f:
+            f.write(repr(self.lease_expires))
+        os.replace(temporary, self.lease_file)
+
+
+class WorkerAgent:
+    def __init__(self, worker_id: str, host: str, port: int, token: str, max_browsers: int, work_dir: str,
+                 bot_script: str, bot_arguments: List[str]):
+        self.worker_id = worker_id
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_browsers = max_browsers
+        self.work_dir = work_dir
+        self.bot_script = bot_script
+        self.bot_arguments = bot_arguments
+        self.bots: Dict[str, BotProcess] = dict()
+        self.stopping: Dict[str, threading.Thread] = dict()
+        self.lock = threading.Lock()
+        self.connection: Optional[socket.socket] = None
+
+    def run(self):
+        last_heartbeat = 0.0
+        while 1:
+            if self.connection is None:
+                self.__connect()
+
+            if self.connection is not None and time() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                self.__send_heartbeat()
+                last_heartbeat = time()
+
+            self.__supervise()
+            sleep(WORKER_TICK)
+
+    def __connect(self):
+        try:
+            connection = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        except OSError:
+            return
+
+        connection.settimeout(None)
+        self.connection = connection
+        self.__send({'type': 'hello', 'worker': self.worker_id, 'token': self.token, 'cpus': os.cpu_count() or 1,
+                     'max_browsers': self.max_browsers})
+        threading.Thread(target=self.__read_messages, args=(connection,), daemon=True).start()
+        print('Connected to coordinator {}:{}.'.format(self.host, self.port))
+
+    def __read_messages(self, connection: socket.socket):
+        try:
+            for line in connection.makefile('rb'):
+                self.__handle(json.loads(line))
+        except (OSError, ValueError, KeyError):
+            pass
+
+        print('Lost connection to the coordinator.')
+        with self.lock:
+            if self.connection is connection:
+                self.connection = None
+        connection.close()
+
+    def __send(self, message: dict):
+        connection = self.connection
+        if connection is None:
+            return
+
+        try:
+            connection.sendall((json.dumps(message) + '\n').encode())
+        except OSError:
+            connection.close()
+
+    def __send_heartbeat(self):
+        load, memory = read_host_stats()
+        with self.lock:
+            running = [bot.key for bot in self.bots.values() if bot.process is not None and bot.process.poll() is None]
+            held = list(self.bots.keys())
+            fired_jobs = {bot.key: read_fired_jobs(bot.directory) for bot in self.bots.values()}
+        self.__send({'type': 'heartbeat', 'load': load, 'memory': memory, 'browsers': len(running),
+                     'accounts': held, 'fired_jobs': fired_jobs})
+
+    def __handle(self, message: dict):
+        with self.lock:
+            if message['type'] == 'assign':
+                account = message['account']
+                bot = self.bots.get(account['key'])
+                if bot is None:
+                    bot = BotProcess(account['key'], path.abspath(path.join(self.work_dir, account['key'])))
+                    self.bots[bot.key] = bot
+                write_bot_files(bot.directory, account, message['jobs'])
+                bot.renew(message['lease'])
+                print('Took over {}.'.format(bot.key))
+            elif message['type'] == 'renew':
+                for key in message['accounts']:
+                    if key in self.bots:
+                        self.bots[key].renew(message['lease'])
+            elif message['type'] == 'revoke':
+                bot = self.bots.pop(message['key'], None)
+                if bot is not None:
+                    self.__stop_bot(bot)
+                    print('Gave up {}.'.format(bot.key))
+            elif message['type'] == 'jobs':
+                bot = self.bots.get(message['key'])
+                if bot is not None:
+                    with open(path.join(bot.directory, JOBS_FILE_NAME), mode='w') as f:
+                        f.write(message['jobs'])
+
+    def __supervise(self):
+        with self.lock:
+            self.stopping = {key: stopper for key, stopper in self.stopping.items() if stopper.is_alive()}
+            for key, bot in list(self.bots.items()):
+                if bot.lease_expires < time():
+                    self.__stop_bot(bot)
+                    del self.bots[key]
+                    print('Lease of {} expired, stopping its bot.'.format(key))
+                elif key in self.stopping:
+                    continue
+                elif bot.process is None or bot.process.poll() is not None:
+                    if bot.process is not None and bot.exited == 0.0:
+                        bot.exited = time()
+                        print('Bot of {} exited with code {}.'.format(key, bot.process.returncode))
+                    if bot.process is None or time() - bot.exited >= BOT_RESTART_DELAY:
+                        bot.process = self.__start_bot(bot)
+                        bot.exited = 0.0
+
+    # Stopping a bot can take BOT_STOP_TIMEOUT, which must not hold up the heartbeats or the other bots, so it
+    # happens on its own thread. A new bot for the same account is only started once the old one is gone.
+    def __stop_bot(self, bot: BotProcess):
+        stopper = threading.Thread(target=stop_process, args=(bot.process,))
+        self.stopping[bot.key] = stopper
+        stopper.start()
+
+    def __start_bot(self, bot: BotProcess) -> subprocess.Popen:
+        command = [sys.executable, path.abspath(self.bot_script), '--files-dir', bot.directory,
+                   '--jobs', path.join(bot.directory, JOBS_FILE_NAME), '--lease-file', bot.lease_file] \
+                  + self.bot_arguments
+        log = open(path.join(bot.directory, BOT_LOG_FILE_NAME), mode='a')
+        if os.name == 'posix':
+            process = subprocess.Popen(command, cwd=path.dirname(path.abspath(self.bot_script)),
+                                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+        else:
+            process = subprocess.Popen(command, cwd=path.dirname(path.abspath(self.bot_script)),
+                                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                       creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        log.close()
+        print('Started bot of {} (pid {}).'.format(bot.key, process.pid))
+        return process
+
+
+
+HEARTBEAT_INTERVAL = 5
+LEASE_DURATION = 30
+LEASE_SAFETY_MARGIN = 5
+COORDINATOR_TICK = 1
+WORKER_TICK = 1
+CONNECT_TIMEOUT = 5
+WORKER_TIMEOUT = 30
+BOT_RESTART_DELAY = 30
+BOT_STOP_TIMEOUT = 10
+ACCOUNT_DETAILS_FILE_NAME = 'accountDetails.txt'
+ASPECTS_FILE_NAME = 'aspects.txt'
+JOBS_FILE_NAME = 'jobs.txt'
+FIRED_JOBS_FILE_NAME = 'firedJobs.txt'
+BOT_LOG_FILE_NAME = 'bot.log'
+LEASE_FILE_NAME = 'lease'
+DEFAULT_PORT = 7500
+DEFAULT_TOKEN_FILE = 'files/fleetToken.txt'
+ASPECT_PAIRS = [('HUMAN', 'BEAST'), ('KNOWLEDGE', 'DESTRUCTION'), ('ORDER', 'CHAOS'), ('NATURE', 'CORRUPTION')]
+
+
+def read_fleet_accounts(file_name: str) -> List[FleetAccount]:
+    accounts = []
+    with open(file_name) as f:
+        for number, line in enumerate(f, start=1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+
+            if len(words) != 8 or not words[0].isnumeric():
+                raise ValueError('Line {} of {} should look like: '
+                                 'county username password jobs_file aspect aspect aspect aspect'
+                                 .format(number, file_name))
+
+            aspects = [w.upper() for w in words[4:]]
+            pairs = [next((i for i, pair in enumerate(ASPECT_PAIRS) if aspect in pair), None) for aspect in aspects]
+            if None in pairs or len(set(pairs)) != len(ASPECT_PAIRS):
+                raise ValueError('Line {} of {} should name 4 aspects in preference order, one of each pair: {}'
+                                 .format(number, file_name, ', '.join('/'.join(pair) for pair in ASPECT_PAIRS)))
+
+            accounts.append(FleetAccount(int(words[0]), words[1], words[2], words[3], aspects))
+
+    return accounts
+
+
+def write_bot_files(directory: str, account: dict, jobs: str):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    with open(path.join(directory, ACCOUNT_DETAILS_FILE_NAME), mode='w') as f:
+        f.write('{}\n{}\n{}\n'.format(account['county'], account['username'], account['password']))
+    with open(path.join(directory, ASPECTS_FILE_NAME), mode='w') as f:
+        f.write(''.join(aspect + '\n' for aspect in account['aspects']))
+    with open(path.join(directory, JOBS_FILE_NAME), mode='w') as f:
+        f.write(jobs)
+    fired_jobs = sorted(set(read_fired_jobs(directory) + account.get('fired_jobs', [])))
+    with open(path.join(directory, FIRED_JOBS_FILE_NAME), mode='w') as f:
+        f.write(''.join(line + '\n' for line in fired_jobs))
+
+
+def read_fired_jobs(directory: str) -> List[str]:
+    try:
+        with open(path.join(directory, FIRED_JOBS_FILE_NAME)) as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def stop_process(process: Optional[subprocess.Popen]):
+    if process is None or process.poll() is not None:
+        return
+
+    if os.name == 'posix':
+        os.killpg(process.pid, signal.SIGTERM)
+    else:
+        process.terminate()
+
+    try:
+        process.wait(BOT_STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        process.wait()
+
+
+# The coordinator sends the account passwords to its workers, so only workers that know the fleet's token are
+# accepted. The coordinator creates the token file on its first start; it is then copied to every worker.
+def read_or_make_token(file_name: str, create: bool) -> str:
+    if create and not path.exists(file_name):
+        Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+        with os.fdopen(os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), mode='w') as f:
+            f.write(secrets.token_hex(32) + '\n')
+        print('Created the fleet token {}, copy it to every worker.'.format(file_name))
+
+    with open(file_name) as f:
+        token = f.read().strip()
+    if not token:
+        raise ValueError('The fleet token {} is empty.'.format(file_name))
+    return token
+
+
+def read_host_stats():
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = 0.0
+
+    memory = 0.0
+    try:
+        with open('/proc/meminfo') as f:
+            info = {line.split(':')[0]: int(line.split()[1]) for line in f}
+        memory = 1 - info['MemAvailable'] / info['MemTotal']
+    except (OSError, KeyError, ValueError, IndexError):
+        pass
+
+    return load, memory
+
+
+def run_coordinator(arguments):
+    try:
+        accounts = read_fleet_accounts(arguments.accounts)
+        token = read_or_make_token(arguments.token_file, True)
+    except (OSError, ValueError) as e:
+        print(e)
+        print('Terminating.')
+        return
+
+    coordinator = Coordinator(accounts)
+    server = CoordinatorServer(arguments.host, arguments.port, coordinator, token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Coordinating {} accounts on {}:{}'.format(len(accounts), arguments.host, arguments.port))
+
+    while 1:
+        coordinator.tick()
+        sleep(COORDINATOR_TICK)
+
+
+def run_worker(arguments, bot_arguments: List[str]):
+    try:
+        token = read_or_make_token(arguments.token_file, False)
+    except (OSError, ValueError) as e:
+        print(e)
+        print('Terminating.')
+        return
+
+    host, _, port = arguments.coordinator.rpartition(':')
+    agent = WorkerAgent(arguments.id, host or '127.0.0.1', int(port or DEFAULT_PORT), token, arguments.max_browsers,
+                        arguments.work_dir, arguments.bot_script, bot_arguments)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        agent.run()
+    finally:
+        for bot in agent.bots.values():
+            stop_process(bot.process)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Runs many BiteFight accounts over several machines.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinator', help='hand out the accounts to the connected workers')
+    coordinator.add_argument('--accounts', metavar='FILE', default='files/fleetAccounts.txt',
+                             help='one account per line: county username password jobs_file and 4 aspects')
+    coordinator.add_argument('--host', default='127.0.0.1',
+                             help='address to listen on, e.g. 0.0.0.0 to accept workers from other machines '
+                                  '(default: 127.0.0.1)')
+    coordinator.add_argument('--token-file', metavar='FILE', default=DEFAULT_TOKEN_FILE,
+                             help='secret shared with the workers, created if missing (default: {})'
+                             .format(DEFAULT_TOKEN_FILE))
+    coordinator.add_argument('--port', type=int, default=DEFAULT_PORT,
+                             help='port to listen on (default: {})'.format(DEFAULT_PORT))
+
+    worker = commands.add_parser('worker', help='run the accounts the coordinator assigns to this machine',
+                                 epilog='Any other arguments are passed on to every bot.')
+    worker.add_argument('--id', required=True, help='name of this worker, unique in the fleet')
+    worker.add_argument('--coordinator', metavar='HOST:PORT', default='127.0.0.1:{}'.format(DEFAULT_PORT))
+    worker.add_argument('--token-file', metavar='FILE', default=DEFAULT_TOKEN_FILE,
+                        help="copy of the coordinator's token file (default: {})".format(DEFAULT_TOKEN_FILE))
+    worker.add_argument('--max-browsers', metavar='N', type=int, default=0,
+                        help='most accounts this worker runs at once (default: no limit)')
+    worker.add_argument('--work-dir', metavar='DIR', default='files/worker',
+                        help='where the files of every assigned account are kept (default: files/worker)')
+    worker.add_argument('--bot-script', metavar='FILE', default=path.join(path.dirname(__file__), 'main.py'),
+                        help='program started for every account (default: main.py)')
+
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    parsed_arguments, extra_arguments = parse_arguments()
+    if parsed_arguments.command == 'coordinator':
+        run_coordinator(parsed_arguments)
+    else:
+        run_worker(parsed_arguments, extra_arguments)
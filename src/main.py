@@ -1,13 +1,29 @@
 import sys
+import os
 import threading
 import abc
-
-from os import path
+import argparse
+import cProfile
+import operator
+import pstats
+import re
+import signal
+import socket
+import socketserver
+import struct
+
+from os import path, stat, replace
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from datetime import datetime, time as clock_time
 from pathlib import Path
 from enum import Enum, IntEnum
 from queue import Queue
-from time import sleep
-from typing import List, Dict
+from time import sleep, time, perf_counter
+from typing import List, Dict, Tuple, Optional, Callable
 from threading import Event
 
 from selenium import webdriver
@@ -43,6 +59,14 @@ class ManHuntTarget(IntEnum):
     METROPOLIS = 5
 
 
+class ActionType(IntEnum):
+    MANHUNT = 1
+    GROTTO = 2
+    TAVERN = 3
+    GRAVEYARD = 4
+    HEAL = 5
+
+
 class Aspect(Enum):
     HUMAN = 1
     BEAST = 2
@@ -120,6 +144,42 @@ class Err(Result):
 
 
 
+class Clock:
+    def time(self) -> float:
+        return time()
+
+    def monotonic(self) -> float:
+        return perf_counter()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def sleep(self, seconds: float):
+        sleep(seconds)
+
+
+# Time only moves when someone sleeps, so a simulated day of graveyard shifts and regeneration waits passes in
+# as long as the Python work takes.
+class VirtualClock(Clock):
+    def __init__(self, start: float):
+        self.current = start
+        self.lock = threading.Lock()
+
+    def time(self) -> float:
+        return self.current
+
+    def monotonic(self) -> float:
+        return self.current
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.current)
+
+    def sleep(self, seconds: float):
+        with self.lock:
+            self.current += max(seconds, 0)
+
+
+
 class Account:
     def __init__(self, county: int, username: str, password: str):
         self.county = county
@@ -132,6 +192,86 @@ class Account:
 
 
 
+class PlayerStatus:
+    def __init__(self, gold: int, ap: int, hp: int):
+        self.gold = gold
+        self.ap = ap
+        self.hp = hp
+
+
+class LedgerTotals:
+    def __init__(self):
+        self.count = 0
+        self.ap = 0
+        self.gold = 0
+        self.experience = 0
+        self.damage = 0
+
+    def add(self, ap: int, gold: int, experience: int, damage: int):
+        self.count += 1
+        self.ap += ap
+        self.gold += gold
+        self.experience += experience
+        self.damage += damage
+
+    def gold_per_ap(self) -> float:
+        return self.gold / self.ap if self.ap else 0.0
+
+    def experience_per_ap(self) -> float:
+        return self.experience / self.ap if self.ap else 0.0
+
+    def experience_per_hp(self) -> float:
+        return self.experience / self.damage if self.damage > 0 else float(self.experience)
+
+
+# Append-only file of fixed size records, one per hunt/fight. The totals per (action type, option) are built
+# once when the file is loaded and then kept up to date on every append, so queries never rescan the file.
+class OutcomeLedger:
+    RECORD = struct.Struct('<IBBhiii')  # timestamp, action type, option, ap, gold, experience, damage
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.totals: Dict[Tuple[ActionType, int], LedgerTotals] = dict()
+        self.__load()
+
+    def __load(self):
+        if not path.exists(self.file_name):
+            return
+
+        with open(self.file_name, mode='rb') as f:
+            data = f.read()
+
+        usable = len(data) - len(data) % self.RECORD.size
+        if usable != len(data):
+            with open(self.file_name, mode='r+b') as f:
+                f.truncate(usable)
+
+        for _, action_type, option, ap, gold, experience, damage in self.RECORD.iter_unpack(data[:usable]):
+            self.__totals_of(ActionType(action_type), option).add(ap, gold, experience, damage)
+
+    def __totals_of(self, action_type: ActionType, option: int) -> LedgerTotals:
+        key = (action_type, option)
+        if key not in self.totals:
+            self.totals[key] = LedgerTotals()
+        return self.totals[key]
+
+    def record(self, action_type: ActionType, option: int, ap: int, gold: int, experience: int, damage: int):
+        with open(self.file_name, mode='ab') as f:
+            f.write(self.RECORD.pack(int(clock.time()), int(action_type), option, ap, gold, experience, damage))
+        self.__totals_of(action_type, option).add(ap, gold, experience, damage)
+
+    def totals_of(self, action_type: ActionType, option: int) -> LedgerTotals:
+        return self.totals.get((action_type, option), LedgerTotals())
+
+    def best_option(self, action_type: ActionType, options: List[int], key) -> int:
+        unexplored = [o for o in options if self.totals_of(action_type, o).count < LEDGER_MIN_SAMPLES]
+        if unexplored:
+            return min(unexplored, key=lambda o: self.totals_of(action_type, o).count)
+
+        return max(options, key=lambda o: key(self.totals_of(action_type, o)))
+
+
+
 def check_for_window(func):
     def inner(*args, **kwargs):
         try:
@@ -159,6 +299,9 @@ def check_for_mission_window():
 
 
 class Action(metaclass=abc.ABCMeta):
+    action_type: ActionType
+    queued_at = 0.0
+
     @abc.abstractmethod
     def execute(self) -> Result:
         pass
@@ -169,27 +312,34 @@ class Action(metaclass=abc.ABCMeta):
 
 
 class ManHuntAction(Action):
-    def __init__(self, target: ManHuntTarget, amount: int):
+    action_type = ActionType.MANHUNT
+
+    def __init__(self, target: Optional[ManHuntTarget], amount: int):
         self.target = target
         self.amount = amount
 
     @check_for_window
     def execute(self) -> Result:
+        target = self.target if self.target is not None else choose_manhunt_target()
         driver.find_element_by_link_text('Hunt').click()
-        click(driver.find_elements_by_class_name('mjs')[int(self.target)-1])
+        status = get_player_status()
+        click(driver.find_elements_by_class_name('mjs')[int(target)-1])
+        status = record_outcome(ActionType.MANHUNT, target, get_manhunt_target_cost(target), status)
 
-        iterations = min(int(get_AP()/get_manhunt_target_cost(self.target)), self.amount)
+        iterations = min(int(status.ap/get_manhunt_target_cost(target)), self.amount)
         counter = 1
         while counter < iterations:
             try:
                 while counter < iterations:
                     click(driver.find_element_by_xpath('//button[text()="Again "]'))
                     check_for_mission_window()
+                    status = record_outcome(ActionType.MANHUNT, target, get_manhunt_target_cost(target), status)
                     counter += 1
             except NoSuchElementException:
                 click(driver.find_element_by_xpath('//a[text()="back"]').find_element_by_xpath('..'))
-                click(driver.find_elements_by_class_name('mjs')[int(self.target) - 1])
+                click(driver.find_elements_by_class_name('mjs')[int(target) - 1])
                 check_for_mission_window()
+                status = record_outcome(ActionType.MANHUNT, target, get_manhunt_target_cost(target), status)
                 counter += 1
 
         if iterations != self.amount:
@@ -198,34 +348,56 @@ class ManHuntAction(Action):
             return Ok('ManHunt action finished successfully.')
 
     def __str__(self):
-        return '{}({})'.format(self.target.name,self.amount)
+        return '{}({})'.format(self.target.name if self.target is not None else 'AUTO', self.amount)
 
 
 def get_manhunt_target_cost(target: ManHuntTarget):
     if target == ManHuntTarget.FARM or target == ManHuntTarget.VILLAGE:
         return 1
-    if target == ManHuntTarget.SMALL_TOWN or ManHuntTarget.CITY:
+    if target == ManHuntTarget.SMALL_TOWN or target == ManHuntTarget.CITY:
         return 2
     if target == ManHuntTarget.METROPOLIS:
         return 3
 
 
+def choose_manhunt_target() -> ManHuntTarget:
+    return ManHuntTarget(ledger.best_option(ActionType.MANHUNT, [int(t) for t in ManHuntTarget],
+                                            LedgerTotals.gold_per_ap))
+
+
+def choose_grotto_difficulty() -> Difficulty:
+    return Difficulty(ledger.best_option(ActionType.GROTTO, [int(d) for d in Difficulty], LedgerTotals.gold_per_ap))
+
+
+def record_outcome(action_type: ActionType, option: int, ap: int, before: PlayerStatus) -> PlayerStatus:
+    after = get_player_status()
+    ledger.record(action_type, int(option), ap, after.gold - before.gold, get_report_experience(),
+                  before.hp - after.hp)
+    iterations_done.inc(action=action_type.name)
+    return after
+
+
 class GrottoAction(Action):
-    def __init__(self, difficulty: Difficulty, amount: int):
+    action_type = ActionType.GROTTO
+
+    def __init__(self, difficulty: Optional[Difficulty], amount: int):
         self.difficulty = difficulty
         self.amount = amount
 
     @check_for_window
     def execute(self) -> Result:
+        difficulty = self.difficulty if self.difficulty is not None else choose_grotto_difficulty()
         driver.find_element_by_link_text('City').click()
         click(driver.find_element_by_link_text('Grotto'))
 
-        iterations = min(get_AP(),self.amount)
-        hp_guard = 2000 + 1000*int(self.difficulty)
+        status = get_player_status()
+        iterations = min(status.ap,self.amount)
+        hp_guard = 2000 + 1000*int(difficulty)
         counter = 0
-        while counter < iterations and get_HP() > hp_guard:
-            click(driver.find_elements_by_name('difficulty')[int(self.difficulty)-1])
+        while counter < iterations and status.hp > hp_guard:
+            click(driver.find_elements_by_name('difficulty')[int(difficulty)-1])
             check_for_mission_window()
+            status = record_outcome(ActionType.GROTTO, difficulty, 1, status)
             click(driver.find_element_by_xpath('//a[text()="back"]').find_element_by_xpath('..'))
             counter += 1
 
@@ -237,20 +409,25 @@ class GrottoAction(Action):
             return Ok('Grotto action finished successfully.')
 
     def __str__(self):
-        return 'Grotto({}, {})'.format(self.difficulty.name,self.amount)
+        return 'Grotto({}, {})'.format(self.difficulty.name if self.difficulty is not None else 'AUTO',self.amount)
 
 
 class GraveyardAction(Action):
+    action_type = ActionType.GRAVEYARD
+
     def __init__(self, amount: int):
         self.amount = amount
 
     @check_for_window
     def execute(self) -> Result:
+        global graveyard_shift_end
         driver.find_element_by_link_text('City').click()
         click(driver.find_element_by_link_text('Graveyard'))
         for i in range(0,self.amount):
             driver.find_element_by_name('dowork').click()
-            sleep((60 * 15) + 5)
+            graveyard_shift_end = clock.time() + 60 * 15
+            iterations_done.inc(action=self.action_type.name)
+            clock.sleep((60 * 15) + 5)
 
         return Ok('Graveyard action finished successfully.')
 
@@ -259,6 +436,8 @@ class GraveyardAction(Action):
 
 
 class TavernAction(Action):
+    action_type = ActionType.TAVERN
+
     def __init__(self, amount: int):
         self.amount = amount
 
@@ -276,6 +455,7 @@ class TavernAction(Action):
         story_count = 0
         while 1:
             story_count += 1
+            iterations_done.inc(action=self.action_type.name)
             counter = 1
             while counter < 40:
                 choices = [btn.text.strip() for btn in driver.find_elements_by_class_name('btn')[1:]]
@@ -330,6 +510,8 @@ def calculate_tavern_choice_value(name: str) -> int:
 
 
 class HealAction(Action):
+    action_type = ActionType.HEAL
+
     @check_for_window
     def execute(self):
         driver.find_element_by_link_text('City').click()
@@ -389,38 +571,863 @@ class NeutralChoice(StoryChoice):
 
 
 
+class Condition:
+    OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq}
+
+    def __init__(self, attribute: str, comparison: str, value: int):
+        self.attribute = attribute
+        self.comparison = comparison
+        self.value = value
+
+    def is_satisfied(self, status: PlayerStatus) -> bool:
+        return self.OPERATORS[self.comparison](getattr(status, self.attribute), self.value)
+
+
+class TimeWindow:
+    def __init__(self, start: clock_time, end: clock_time):
+        self.start = start
+        self.end = end
+
+    def contains(self, moment: datetime) -> bool:
+        now = moment.time()
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        else:
+            return now >= self.start or now < self.end
+
+
+class JobRule:
+    def __init__(self, line: str, recurring: bool, create_action: Callable[[], Action],
+                 conditions: List[Condition], window: Optional[TimeWindow]):
+        self.line = line
+        self.recurring = recurring
+        self.create_action = create_action
+        self.conditions = conditions
+        self.window = window
+
+    def is_due(self, status: PlayerStatus, moment: datetime) -> bool:
+        if self.window is not None and not self.window.contains(moment):
+            return False
+
+        return all(condition.is_satisfied(status) for condition in self.conditions)
+
+
+class JobFile:
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.modified: Optional[float] = -1.0
+        self.rules: List[JobRule] = []
+
+    def reload_if_changed(self) -> Result:
+        try:
+            modified = stat(self.file_name).st_mtime
+        except OSError:
+            modified = None
+
+        if modified == self.modified:
+            return Ok(False)
+
+        self.modified = modified
+        if modified is None:
+            return Err('Job file {} could not be read.'.format(self.file_name))
+
+        parse_result = parse_job_file(self.file_name)
+        if parse_result.is_err():
+            return parse_result
+
+        self.rules = parse_result.value
+        return Ok(True)
+
+
+# Rules are checked in file order against the cached player status, and only when the queue is empty. At most
+# one rule fires per check, so the status is refreshed after each action before the next rule is considered.
+# Every rule that holds is remembered from the check it was first found due, and its action counts as queued
+# from then on, so the queue latency shows how long lower priority rules are kept waiting.
+# A recurring rule whose action neither spent AP nor changed the gold is held back for JOB_RETRY_DELAY, so an
+# action that keeps failing (a heal without enough AP) is not repeated back to back. The lines of "once" rules
+# that fired are appended to fired_file, so a restart does not perform them again.
+class JobPlanner:
+    def __init__(self, job_file: JobFile, monitor: Optional['StatusMonitor'] = None,
+                 fired_file: Optional[str] = None):
+        self.job_file = job_file
+        self.fired_file = fired_file
+        self.fired = set()
+        if fired_file is not None and path.isfile(fired_file):
+            with open(fired_file) as f:
+                self.fired = {line.strip() for line in f if line.strip()}
+        self.held_until: Dict[str, float] = dict()
+        self.due_since: Dict[str, float] = dict()
+        self.last_rule: Optional[JobRule] = None
+        self.last_status: Optional[PlayerStatus] = None
+        self.status: Optional[PlayerStatus] = None
+        self.status_time = 0.0
+        self.monitor = monitor
+        self.invalidated_at = clock.time()
+        if monitor is not None:
+            monitor.subscribe(self.update_status)
+
+    def plan(self) -> Result:
+        reload_result = self.job_file.reload_if_changed()
+        if reload_result.is_err():
+            print(reload_result.value, 'Keeping the previous jobs.')
+        elif reload_result.value:
+            print('Job file loaded with {} rules.'.format(len(self.job_file.rules)))
+
+        if self.monitor is not None and self.monitor_overdue():
+            print('No fresh reading from the status monitor, reading the status from the tab.')
+            remember_session_cookies()
+            refresh_result = self.refresh_status()
+            if refresh_result.is_err():
+                return refresh_result
+        elif self.monitor is not None:
+            if self.status is None or self.status_time <= self.invalidated_at:
+                return Ok()
+        elif self.status is None or clock.time() - self.status_time > STATUS_REFRESH_INTERVAL:
+            refresh_result = self.refresh_status()
+            if refresh_result.is_err():
+                return refresh_result
+
+        if self.last_rule is not None:
+            if self.last_rule.recurring and not self.made_progress(self.last_status, self.status):
+                self.held_until[self.last_rule.line] = clock.time() + JOB_RETRY_DELAY
+                print('Job made no progress, retrying in {} minutes: {}'.format(JOB_RETRY_DELAY // 60,
+                                                                                 self.last_rule.line))
+            self.last_rule = None
+
+        moment = clock.now()
+        now = clock.time()
+        chosen = None
+        for rule in self.job_file.rules:
+            if (not rule.recurring and rule.line in self.fired) or self.held_until.get(rule.line, 0.0) > now:
+                self.due_since.pop(rule.line, None)
+            elif rule.is_due(self.status, moment):
+                self.due_since.setdefault(rule.line, now)
+                if chosen is None:
+                    chosen = rule
+            else:
+                self.due_since.pop(rule.line, None)
+
+        if chosen is not None:
+            action = chosen.create_action()
+            queue_action(action, self.due_since.pop(chosen.line))
+            self.fired.add(chosen.line)
+            if not chosen.recurring and self.fired_file is not None:
+                with open(self.fired_file, mode='a') as f:
+                    f.write(chosen.line + '\n')
+            self.last_rule = chosen
+            self.last_status = self.status
+            print('Job queued: ', action)
+
+        return Ok()
+
+    # The monitor polls every interval and at once after an action. If no reading arrives STATUS_REFRESH_INTERVAL
+    # after the expected one, the status is read from the tab, which also refreshes the cookies the monitor uses.
+    def monitor_overdue(self) -> bool:
+        expected = max(self.status_time + self.monitor.interval, self.invalidated_at)
+        return clock.time() - expected > STATUS_REFRESH_INTERVAL
+
+    @staticmethod
+    def made_progress(before: PlayerStatus, after: PlayerStatus) -> bool:
+        return after.ap < before.ap or after.gold != before.gold
+
+    @check_for_window
+    def refresh_status(self) -> Result:
+        self.status = get_player_status()
+        self.status_time = clock.time()
+        return Ok()
+
+    def update_status(self, status: PlayerStatus, polled_at: float):
+        self.status = status
+        self.status_time = polled_at
+
+    def invalidate_status(self):
+        if self.monitor is None:
+            self.status = None
+        else:
+            self.invalidated_at = clock.time()
+            self.monitor.poll_now()
+
+
+class StatusBarParser(HTMLParser):
+    VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track',
+                     'wbr'}
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.found = False
+        self.texts: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_ELEMENTS:
+            return
+
+        if self.depth:
+            self.depth += 1
+        elif not self.found and 'gold' in (dict(attrs).get('class') or '').split():
+            self.depth = 1
+            self.found = True
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        if self.depth and tag not in self.VOID_ELEMENTS:
+            self.depth -= 1
+
+    def handle_data(self, data):
+        if self.depth == 1:
+            self.texts.append(data)
+
+
+# Reads the status bar from the profile page over its own HTTP connection, using the browser's cookies, so the
+# tab the actions work on is never touched. Every reading is passed to the subscribers and printed when it
+# changes.
+class StatusMonitor:
+    def __init__(self, account: Account, interval: float, user_agent: str):
+        self.account = account
+        self.interval = interval
+        self.user_agent = user_agent
+        self.subscribers: List[Callable[[PlayerStatus, float], None]] = []
+        self.wake = Event()
+        self.last_line = ''
+        self.last_error = ''
+
+    def subscribe(self, subscriber: Callable[[PlayerStatus, float], None]):
+        self.subscribers.append(subscriber)
+
+    def start(self):
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def poll_now(self):
+        self.wake.set()
+
+    def __run(self):
+        while 1:
+            poll_result = self.poll()
+            if poll_result.is_err() and poll_result.value != self.last_error:
+                print(poll_result.value)
+            self.last_error = poll_result.value if poll_result.is_err() else ''
+
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def poll(self) -> Result:
+        polled_at = clock.time()
+        cookies = '; '.join('{}={}'.format(cookie['name'], cookie['value']) for cookie in session_cookies)
+        request = Request(self.account.page_url, headers={'Cookie': cookies, 'User-Agent': self.user_agent})
+
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        start = clock.monotonic()
+        try:
+            with urlopen(request, timeout=MONITOR_TIMEOUT) as response:
+                page = response.read().decode('utf-8', errors='replace')
+        except (URLError, OSError) as e:
+            if rate_limiter is not None:
+                rate_limiter.report(clock.monotonic() - start, False)
+            return Err('Status monitor could not reach the game ({}).'.format(e))
+        if rate_limiter is not None:
+            rate_limiter.report(clock.monotonic() - start, True)
+
+        parser = StatusBarParser()
+        parser.feed(page)
+        if not parser.found:
+            return Err('Status monitor could not find the status bar, the session may have expired.')
+
+        try:
+            lines = split_status_bar(''.join(parser.texts))
+            status = PlayerStatus(parse_gold(lines), parse_AP(lines), parse_HP(lines))
+        except (ValueError, IndexError):
+            return Err('Status monitor could not read the status bar.')
+
+        publish_status(status)
+        for subscriber in self.subscribers:
+            subscriber(status, polled_at)
+
+        line = 'AP {}   HP {}   Gold {}'.format(status.ap, status.hp, status.gold)
+        remaining = int(graveyard_shift_end - clock.time())
+        if remaining > 0:
+            line += '   Graveyard {}:{:02d} left'.format(remaining // 60, remaining % 60)
+        if line != self.last_line:
+            print(line)
+            self.last_line = line
+
+        return Ok(status)
+
+
+
+# Runs every action under cProfile and keeps one profile file per action. Time spent inside WebDriver.execute
+# is the time waiting for the browser, everything else is Python overhead.
+# Every action's time is split into the WebDriver commands (browser), the deliberate waits of Clock.sleep and the
+# rate limiter (waiting), and the rest (python).
+class ActionProfiler:
+    def __init__(self, directory: str, top: int):
+        self.directory = directory
+        self.top = top
+        self.files = []
+        self.timings: List[Tuple[str, float, float, float]] = []
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    def execute(self, action: Action) -> Result:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(action.execute)
+
+        label = str(action)
+        file_name = path.join(self.directory, '{:04d}_{}.prof'.format(len(self.files) + 1,
+                                                                      PROFILE_LABEL_PATTERN.sub('_', label).strip('_')))
+        profiler.dump_stats(file_name)
+        self.files.append(file_name)
+
+        stats = pstats.Stats(profiler)
+        browser_time = sum(entry[3] for key, entry in stats.stats.items()
+                           if key[2] == 'execute' and key[0].endswith(WEBDRIVER_MODULE_SUFFIX))
+        self.timings.append((label, stats.total_tt, browser_time, self.waiting_time(stats)))
+        return result
+
+    @staticmethod
+    def waiting_time(stats: pstats.Stats) -> float:
+        acquire = profile_key(RateLimiterClient.acquire)
+        sleeps = stats.stats.get(profile_key(Clock.sleep))
+        waiting = stats.stats[acquire][3] if acquire in stats.stats else 0.0
+        if sleeps is not None:
+            waiting += sum(entry[3] for caller, entry in sleeps[4].items() if caller != acquire)
+        return waiting
+
+    def print_summary(self):
+        if not self.files:
+            return
+
+        print('\n{:<24}{:>12}{:>12}{:>12}{:>12}'.format('action', 'total (s)', 'browser (s)', 'waiting (s)',
+                                                         'python (s)'))
+        for label, total, browser_time, waiting in self.timings:
+            print('{:<24}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.2f}'.format(label, total, browser_time, waiting,
+                                                                      total - browser_time - waiting))
+
+        print('\nTop {} functions by own time over all actions (profiles saved in {}):'
+              .format(self.top, self.directory))
+        pstats.Stats(*self.files).sort_stats('tottime').print_stats(self.top)
+
+
+
+def profile_key(function: Callable) -> Tuple[str, int, str]:
+    code = function.__code__
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: Tuple[Tuple[str, str], ...]) -> str:
+    if not key:
+        return ''
+
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in key]
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+
+class Metric:
+    def __init__(self, name: str, description: str, kind: str):
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.kind = kind
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append('{}{} {}'.format(self.name, format_labels(key), value))
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description, 'counter')
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description, 'gauge')
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+    def __init__(self, name: str, description: str, buckets: List[float]):
+        super().__init__(name, description, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            state = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(key + (('le', str(bound)),)),
+                                                         bucket_count))
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(key + (('le', '+Inf'),)), count))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(key), total))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(key), count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_name: str):
+        with open(file_name + '.tmp', mode='w') as f:
+            f.write(self.render())
+        replace(file_name + '.tmp', file_name)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def instrument_driver(web_driver: WebDriver):
+    execute = web_driver.execute
+
+    def instrumented_execute(driver_command, params=None):
+        webdriver_commands.inc(command=driver_command)
+        if driver_command not in PAGE_LOAD_COMMANDS:
+            return execute(driver_command, params)
+
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        start = clock.monotonic()
+        succeeded = False
+        try:
+            result = execute(driver_command, params)
+            succeeded = True
+            return result
+        finally:
+            latency = clock.monotonic() - start
+            page_load_seconds.observe(latency, command=driver_command)
+            if rate_limiter is not None:
+                rate_limiter.report(latency, succeeded)
+
+    web_driver.execute = instrumented_execute
+
+
+def update_browser_memory():
+    try:
+        browser_memory_bytes.set(driver.execute_script('return performance.memory.usedJSHeapSize'))
+    except WebDriverException:
+        pass
+
+
+
+# Shared by every instance on the host through RateLimiterServer. The rate grows a little after every fast
+# response and is halved (at most once per LIMITER_DECREASE_INTERVAL) after a slow or failed one.
+class TokenBucket:
+    def __init__(self):
+        self.rate = LIMITER_INITIAL_RATE
+        self.tokens = float(LIMITER_BURST)
+        self.updated = clock.time()
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while 1:
+            with self.lock:
+                now = clock.time()
+                self.tokens = min(LIMITER_BURST, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            clock.sleep(wait)
+
+    def report(self, latency: float, succeeded: bool):
+        with self.lock:
+            if not succeeded or latency > LIMITER_SLOW_LATENCY:
+                if clock.time() - self.last_decrease > LIMITER_DECREASE_INTERVAL:
+                    self.rate = max(LIMITER_MIN_RATE, self.rate / 2)
+                    self.last_decrease = clock.time()
+            else:
+                self.rate = min(LIMITER_MAX_RATE, self.rate + LIMITER_INCREASE)
+
+
+class RateLimiterRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode().split()
+            if words == ['acquire']:
+                self.server.bucket.acquire()
+                self.wfile.write('ok {}\n'.format(self.server.bucket.rate).encode())
+            elif len(words) == 3 and words[0] == 'report':
+                self.server.bucket.report(float(words[1]), words[2] == '1')
+
+
+# The connections of a host that just died linger on the port for a while, so the port is reused on POSIX to let
+# another instance take over at once. Windows would let two hosts share the port that way, so there it is
+# claimed exclusively instead.
+class RateLimiterServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = os.name == 'posix'
+
+    def __init__(self, port: int):
+        super().__init__(('127.0.0.1', port), RateLimiterRequestHandler)
+        self.bucket = TokenBucket()
+
+    def server_bind(self):
+        if os.name == 'nt':
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        super().server_bind()
+
+
+# The first instance that finds the port free hosts the limiter, the rest connect to it. If the host goes away
+# the remaining instances reconnect and one of them takes over. While no limiter can be reached, clicks only
+# wait CLICK_DELAY as before.
+class RateLimiterClient:
+    def __init__(self, port: int):
+        self.port = port
+        self.server: Optional[RateLimiterServer] = None
+        self.connection: Optional[socket.socket] = None
+        self.reader = None
+        self.lock = threading.Lock()
+        self.last_error = ''
+
+    def acquire(self):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.__connect()
+                    self.connection.sendall(b'acquire\n')
+                    reply = self.reader.readline().split()
+                    if not reply:
+                        raise OSError('Rate limiter closed the connection.')
+                    limiter_rate.set(float(reply[1]))
+                    return
+                except OSError:
+                    self.__disconnect()
+
+        clock.sleep(CLICK_DELAY)
+
+    def report(self, latency: float, succeeded: bool):
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.sendall('report {:.3f} {}\n'.format(latency, int(succeeded)).encode())
+            except OSError:
+                self.__disconnect()
+
+    def __connect(self):
+        try:
+            self.connection = socket.create_connection(('127.0.0.1', self.port), timeout=LIMITER_CONNECT_TIMEOUT)
+        except OSError:
+            bind_error = None
+            try:
+                self.server = RateLimiterServer(self.port)
+                threading.Thread(target=self.server.serve_forever, daemon=True).start()
+                print('Hosting the rate limiter on port {}.'.format(self.port))
+            except OSError as e:
+                bind_error = e
+
+            try:
+                self.connection = socket.create_connection(('127.0.0.1', self.port),
+                                                           timeout=LIMITER_CONNECT_TIMEOUT)
+            except OSError as e:
+                error = 'Rate limiter on port {} could not be reached or hosted ({}), clicks are not shared.' \
+                    .format(self.port, bind_error or e)
+                if error != self.last_error:
+                    print(error)
+                self.last_error = error
+                raise
+
+        self.last_error = ''
+        self.connection.settimeout(None)
+        self.reader = self.connection.makefile('rb')
+
+    def __disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.reader = None
+
+
+
+# Keeps a few browsers open on the game, ready to replace the working one when it fails or is recycled. They
+# are not logged in on their own, since a second login would end the working session; instead they get the
+# working browser's cookies when they take over. One spare is kept, plus one for every failure in the last
+# POOL_FAILURE_WINDOW seconds, up to POOL_MAX_SIZE.
+class DriverPool:
+    def __init__(self, account: Account, recycle_after: int):
+        self.account = account
+        self.recycle_after = recycle_after
+        self.actions_done = 0
+        self.spares: List[WebDriver] = []
+        self.failures: List[float] = []
+        self.lock = threading.Lock()
+        self.changed = Event()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.__refill, daemon=True).start()
+
+    def size(self) -> int:
+        now = clock.time()
+        with self.lock:
+            self.failures = [failure for failure in self.failures if now - failure < POOL_FAILURE_WINDOW]
+            return min(POOL_MAX_SIZE, POOL_MIN_SIZE + len(self.failures))
+
+    def report_failure(self) -> int:
+        now = clock.time()
+        with self.lock:
+            self.failures = [failure for failure in self.failures if now - failure < POOL_FAILURE_WINDOW] + [now]
+            failures = len(self.failures)
+        self.changed.set()
+        return failures
+
+    def take(self) -> WebDriver:
+        with self.lock:
+            spare = self.spares.pop(0) if self.spares else None
+            spare_drivers.set(len(self.spares))
+        self.actions_done = 0
+        self.changed.set()
+
+        if spare is None:
+            print('No standby browser is ready, starting a new one.')
+            spare = create_instrumented_driver()
+        return spare
+
+    def should_recycle(self) -> bool:
+        self.actions_done += 1
+        return 0 < self.recycle_after <= self.actions_done
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            spares = self.spares
+            self.spares = []
+        self.changed.set()
+
+        for spare in spares:
+            quit_driver(spare)
+
+    def __refill(self):
+        while not self.closed:
+            size = self.size()
+            with self.lock:
+                extra = self.spares[size:]
+                self.spares = self.spares[:size]
+                missing = size - len(self.spares)
+            for spare in extra:
+                quit_driver(spare)
+
+            if missing <= 0:
+                self.changed.wait(POOL_CHECK_INTERVAL)
+                self.changed.clear()
+                continue
+
+            try:
+                spare = create_instrumented_driver()
+                spare.get(self.account.page_url)
+            except WebDriverException:
+                print('A standby browser could not be started.')
+                clock.sleep(POOL_RETRY_DELAY)
+                continue
+
+            with self.lock:
+                closed = self.closed
+                if not closed:
+                    self.spares.append(spare)
+                    spare_drivers.set(len(self.spares))
+            if closed:
+                quit_driver(spare)
+
+
+
 def create_chrome_web_driver():
     options = Options()
     options.add_experimental_option("excludeSwitches", ["enable-logging"])
     return webdriver.Chrome(executable_path=CHROME_DRIVER, options=options)
 
 
+def create_instrumented_driver() -> WebDriver:
+    web_driver = create_chrome_web_driver()
+    instrument_driver(web_driver)
+    return web_driver
+
+
+def quit_driver(web_driver: WebDriver):
+    try:
+        web_driver.quit()
+    except Exception:
+        pass
+
+
 
 ACCOUNT_DETAILS_FILE_NAME = 'accountDetails.txt'
 ASPECTS_FILE_NAME = 'aspects.txt'
+LEDGER_FILE_NAME = 'ledger_{}_{}.bin'
+FIRED_JOBS_FILE_NAME = 'firedJobs.txt'
+LEDGER_MIN_SAMPLES = 5
 CHROME_DRIVER = 'chromedriver.exe'
 CLICK_DELAY = 0.12
+STATUS_REFRESH_INTERVAL = 60
+JOB_RETRY_DELAY = 300
+JOB_ACTION_ARGUMENTS = {'manhunt': 2, 'grotto': 2, 'tavern': 1, 'graveyard': 1, 'heal': 0}
+PROFILES_DIRECTORY_NAME = 'profiles'
+PROFILE_LABEL_PATTERN = re.compile(r'[^A-Za-z0-9]+')
+WEBDRIVER_MODULE_SUFFIX = path.join('selenium', 'webdriver', 'remote', 'webdriver.py')
+METRICS_PREFIX = 'odaxelagnia_'
+PAGE_LOAD_COMMANDS = ('get', 'clickElement')
+LIMITER_INITIAL_RATE = 4.0
+LIMITER_MIN_RATE = 0.5
+LIMITER_MAX_RATE = 20.0
+LIMITER_BURST = 4
+LIMITER_INCREASE = 0.1
+LIMITER_SLOW_LATENCY = 2.0
+LIMITER_DECREASE_INTERVAL = 1.0
+LIMITER_CONNECT_TIMEOUT = 2.0
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 3
+POOL_FAILURE_WINDOW = 3600
+POOL_CHECK_INTERVAL = 30
+POOL_RETRY_DELAY = 60
+LEASE_CHECK_INTERVAL = 1
+MONITOR_TIMEOUT = 10
+REPORT_ELEMENT_ID = 'reportResult'
+EXPERIENCE_PATTERN = re.compile(r'([\d.]+)\s+experience', re.IGNORECASE)
 driver: WebDriver
 
 debug_mode: bool = False
+clock: Clock = Clock()
+files_directory = 'files'
 
 actions: Queue[Action] = Queue()
 aspect_value_dict = dict()
 actionRepository = dict()
-
-
-def run():
-    global aspect_value_dict, actionRepository, driver
-
+ledger: OutcomeLedger
+rate_limiter: Optional[RateLimiterClient] = None
+driver_pool: Optional[DriverPool] = None
+session_cookies: List[dict] = []
+status_monitor: Optional[StatusMonitor] = None
+graveyard_shift_end = 0.0
+
+metrics = MetricsRegistry()
+actions_completed = metrics.register(Counter('actions_completed_total', 'Actions that finished, by action type.'))
+actions_failed = metrics.register(Counter('actions_failed_total', 'Actions that returned an error, by action type.'))
+iterations_done = metrics.register(Counter('iterations_total', 'Hunts, fights, stories and shifts performed.'))
+webdriver_commands = metrics.register(Counter('webdriver_commands_total', 'WebDriver commands sent, by command.'))
+login_events = metrics.register(Counter('logins_total', 'Login attempts, by result.'))
+driver_recycles = metrics.register(Counter('driver_recycles_total', 'Browsers replaced by a new one, by reason.'))
+queue_depth = metrics.register(Gauge('queue_depth', 'Actions waiting in the queue.'))
+player_ap = metrics.register(Gauge('player_ap', 'Last known action points.'))
+player_hp = metrics.register(Gauge('player_hp', 'Last known health points.'))
+player_gold = metrics.register(Gauge('player_gold', 'Last known gold.'))
+browser_memory_bytes = metrics.register(Gauge('browser_memory_bytes', 'JavaScript heap used by the game tab.'))
+spare_drivers = metrics.register(Gauge('standby_browsers', 'Standby browsers ready to take over.'))
+limiter_rate = metrics.register(Gauge('limiter_rate', 'Clicks and navigations per second allowed on this host.'))
+action_seconds = metrics.register(Histogram('action_duration_seconds', 'Time taken by each action, by action type.',
+                                            [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]))
+queue_latency_seconds = metrics.register(Histogram('queue_latency_seconds',
+                                                   'Time from an action being queued, or its job rule becoming due, '
+                                                   'to its start.',
+                                                   [1, 10, 60, 300, 900, 1800, 3600, 7200]))
+page_load_seconds = metrics.register(Histogram('page_load_seconds', 'Time taken by navigations and clicks.',
+                                               [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]))
+metrics.add_collector(lambda: queue_depth.set(actions.qsize()))
+
+
+def run(arguments):
+    global aspect_value_dict, actionRepository, driver, ledger, rate_limiter, files_directory, driver_pool, \
+        status_monitor
+
+    files_directory = arguments.files_dir
+    if arguments.lease_file is not None:
+        threading.Thread(target=watch_lease, args=(arguments.lease_file,), daemon=True).start()
     print('Initializing...')
     account = read_or_make_user_account()
+    ledger = OutcomeLedger(path.join(files_directory, LEDGER_FILE_NAME.format(account.county, account.username)))
     aspect_value_dict = read_or_rank_aspect_values()
     actionRepository = create_action_repository()
-    driver = create_chrome_web_driver()
+    if arguments.rate_limit_port is not None:
+        rate_limiter = RateLimiterClient(arguments.rate_limit_port)
+    if arguments.metrics_port is not None:
+        try:
+            start_metrics_server(arguments.metrics_port)
+        except OSError as e:
+            print('Metrics could not be served on port {} ({}).'.format(arguments.metrics_port, e))
+            print('Terminating.')
+            return
+        print('Metrics available at http://127.0.0.1:{}/metrics'.format(arguments.metrics_port))
+
+    if arguments.standby or arguments.recycle_after:
+        driver_pool = DriverPool(account, arguments.recycle_after)
+    driver = create_instrumented_driver()
 
     print('Logging in...')
-    driver.get(account.page_url)
-    login_result = login(account)
+    login_result = start_session(account)
     if login_result.is_ok():
         print('Success\n')
     else:
@@ -430,13 +1437,76 @@ def run():
 
     sys.stdout.flush()
 
-    accept_cookies()
+    if driver_pool is not None:
+        driver_pool.start()
+
+    if arguments.monitor is not None:
+        status_monitor = StatusMonitor(account, arguments.monitor, driver.execute_script('return navigator.userAgent'))
+        status_monitor.start()
+
+    profiler = None
+    if arguments.profile:
+        profiler = ActionProfiler(path.join(files_directory, PROFILES_DIRECTORY_NAME,
+                                            clock.now().strftime('%Y%m%d-%H%M%S')), arguments.profile_top)
 
     exit_event = Event()
-    tasks_thread = threading.Thread(target=get_inputs, args=(exit_event,), daemon=True)
-    tasks_thread.start()
+    try:
+        if arguments.jobs is None:
+            tasks_thread = threading.Thread(target=get_inputs, args=(exit_event,), daemon=True)
+            tasks_thread.start()
 
-    execute_actions(exit_event)
+            execute_actions(exit_event, profiler=profiler, metrics_file=arguments.metrics_file)
+        else:
+            job_file = JobFile(arguments.jobs)
+            load_result = job_file.reload_if_changed()
+            if load_result.is_err():
+                print(load_result.value)
+                print('Terminating.')
+                driver.quit()
+                return
+
+            print('Running unattended with {} job rules.'.format(len(job_file.rules)))
+            planner = JobPlanner(job_file, status_monitor, path.join(files_directory, FIRED_JOBS_FILE_NAME))
+            execute_actions(exit_event, planner, profiler, arguments.metrics_file)
+    finally:
+        if driver_pool is not None:
+            driver_pool.close()
+        if profiler is not None:
+            profiler.print_summary()
+        if arguments.metrics_file is not None:
+            metrics.dump(arguments.metrics_file)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='BiteFight browser automation tool.')
+    parser.add_argument('--files-dir', metavar='DIR', default='files',
+                        help='directory holding the account details, aspects and the other files (default: files)')
+    parser.add_argument('--lease-file', metavar='FILE',
+                        help='terminate once the expiry time in FILE has passed (set by the fleet worker)')
+    parser.add_argument('--jobs', metavar='FILE',
+                        help='run unattended, queueing actions according to the rules of the given job file')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every action and print the most expensive functions on exit')
+    parser.add_argument('--profile-top', metavar='N', type=int, default=20,
+                        help='how many functions the profiling summary lists (default: 20)')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                        help='serve metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='write the metrics to FILE after every action and on exit')
+    parser.add_argument('--rate-limit-port', metavar='PORT', type=int,
+                        help='share an adaptive click rate limiter with the other instances on this host using PORT')
+    parser.add_argument('--standby', action='store_true',
+                        help='keep standby browsers open to take over at once when the working one fails')
+    parser.add_argument('--recycle-after', metavar='N', type=int, default=0,
+                        help='replace the browser with a standby one after every N actions')
+    parser.add_argument('--monitor', metavar='SECONDS', type=float,
+                        help='read AP, HP and gold every SECONDS over a separate connection, without using the tab')
+    return parser.parse_args()
+
+
+def queue_action(action: Action, due_since: Optional[float] = None):
+    action.queued_at = clock.time() if due_since is None else due_since
+    actions.put(action)
 
 
 def get_inputs(exit_event: Event):
@@ -451,15 +1521,149 @@ def get_inputs(exit_event: Event):
             break
 
 
-def execute_actions(exit_event: Event):
+def execute_actions(exit_event: Event, planner: Optional[JobPlanner] = None,
+                    profiler: Optional[ActionProfiler] = None, metrics_file: Optional[str] = None,
+                    recorder=None):
     while not exit_event.is_set():
-        if actions:
-            exec_result = actions.get().execute()
+        if recorder is not None:
+            recorder.tick()
+            if recorder.finished():
+                break
+
+        if planner is not None and actions.empty():
+            plan_result = planner.plan()
+            if plan_result.is_err():
+                print('\n',plan_result.value)
+                if not recover_driver():
+                    exit_event.set()
+                    break
+                continue
+
+        if not actions.empty():
+            action = actions.get()
+            queue_latency = clock.time() - action.queued_at
+            queue_latency_seconds.observe(queue_latency)
+            start = clock.monotonic()
+            exec_result = profiler.execute(action) if profiler is not None else action.execute()
+            action_seconds.observe(clock.monotonic() - start, action=action.action_type.name)
+            if recorder is not None:
+                recorder.record(queue_latency)
             print('\n',exec_result.value)
             if exec_result.is_err():
-                exit_event.set()
+                actions_failed.inc(action=action.action_type.name)
+                if recover_driver():
+                    print('{} did not finish and was dropped.'.format(action))
+                else:
+                    exit_event.set()
+            else:
+                actions_completed.inc(action=action.action_type.name)
+                update_browser_memory()
+                if driver_pool is not None or status_monitor is not None:
+                    remember_session_cookies()
+                if planner is not None:
+                    planner.invalidate_status()
+                if driver_pool is not None and driver_pool.should_recycle():
+                    print('Recycling the browser...')
+                    recycle_result = switch_driver('planned')
+                    if recycle_result.is_err():
+                        print(recycle_result.value)
+                        exit_event.set()
+
+            if metrics_file is not None:
+                metrics.dump(metrics_file)
         else:
-            sleep(1)
+            clock.sleep(1)
+
+# A failure that a new browser does not fix, such as an element the site no longer has, would otherwise replace
+# the browser forever, so the program terminates once the failures in POOL_FAILURE_WINDOW exceed POOL_MAX_SIZE.
+def recover_driver() -> bool:
+    if driver_pool is None:
+        return False
+
+    failures = driver_pool.report_failure()
+    if failures > POOL_MAX_SIZE:
+        print('{} failures in the last {} minutes, a new browser does not help. Terminating.'
+              .format(failures, POOL_FAILURE_WINDOW // 60))
+        return False
+
+    print('Switching to a standby browser...')
+    switch_result = switch_driver('failure')
+    print(switch_result.value if switch_result.is_err() else 'Success\n')
+    return switch_result.is_ok()
+
+
+def switch_driver(reason: str) -> Result:
+    global driver
+
+    switch_result = Err('No browser could take over. Terminating.')
+    for attempt in range(POOL_MAX_SIZE + 1):
+        old_driver = driver
+        try:
+            driver = driver_pool.take()
+        except WebDriverException:
+            break
+
+        quit_driver(old_driver)
+        driver_recycles.inc(reason=reason)
+        switch_result = start_session(driver_pool.account)
+        if switch_result.is_ok():
+            break
+
+    return switch_result
+
+
+@check_for_window
+def start_session(account: Account) -> Result:
+    if session_cookies:
+        if urlparse(driver.current_url).netloc != urlparse(account.page_url).netloc:
+            driver.get(account.page_url)
+        driver.delete_all_cookies()
+        for cookie in session_cookies:
+            driver.add_cookie(cookie)
+
+    driver.get(account.page_url)
+    if driver.find_elements_by_name('user'):
+        login_result = login(account)
+        login_events.inc(result='ok' if login_result.is_ok() else 'failed')
+        if login_result.is_err():
+            return login_result
+
+    accept_cookies()
+    remember_session_cookies()
+    return Ok()
+
+
+# A bot started by a fleet worker runs only while the worker keeps renewing the expiry time in its lease file.
+# If the worker dies, the bot ends itself, its browsers included, before the account is handed to another worker.
+def watch_lease(lease_file: str):
+    while 1:
+        try:
+            with open(lease_file) as f:
+                expires = float(f.read())
+        except (OSError, ValueError):
+            expires = 0.0
+
+        if expires < clock.time():
+            print('The lease on this account ended. Terminating.')
+            sys.stdout.flush()
+            if os.name == 'posix' and os.getpgrp() == os.getpid():
+                os.killpg(os.getpid(), signal.SIGKILL)
+            try:
+                quit_driver(driver)
+            except NameError:
+                pass
+            os._exit(1)
+
+        clock.sleep(LEASE_CHECK_INTERVAL)
+
+
+def remember_session_cookies():
+    global session_cookies
+    try:
+        session_cookies = driver.get_cookies()
+    except WebDriverException:
+        pass
+
 
 @check_for_window
 def login(account: Account) -> Result:
@@ -542,7 +1746,7 @@ def create_action_repository() -> Dict[str, StoryChoice]:
 
 
 def read_or_make_user_account():
-    if path.exists('files/'+ACCOUNT_DETAILS_FILE_NAME):
+    if path.exists(path.join(files_directory, ACCOUNT_DETAILS_FILE_NAME)):
         try:
             return read_account_from_file()
         except Exception:
@@ -553,7 +1757,7 @@ def read_or_make_user_account():
 
 
 def read_account_from_file():
-    with open('files/'+ACCOUNT_DETAILS_FILE_NAME) as f:
+    with open(path.join(files_directory, ACCOUNT_DETAILS_FILE_NAME)) as f:
         county = int(f.readline().strip())
         username = f.readline().strip()
         password = f.readline().strip()
@@ -589,8 +1793,8 @@ def save_user_details():
         else:
             print('Lets try again then\n')
 
-    Path('files').mkdir(parents=True, exist_ok=True)
-    with open('files/'+ACCOUNT_DETAILS_FILE_NAME, mode='w') as f:
+    Path(files_directory).mkdir(parents=True, exist_ok=True)
+    with open(path.join(files_directory, ACCOUNT_DETAILS_FILE_NAME), mode='w') as f:
         f.write(str(county))
         f.write('\n')
         f.write(username)
@@ -634,7 +1838,7 @@ def rank_aspect_values():
 
     assert len(numeric) == 4
 
-    with open('files/' + ASPECTS_FILE_NAME, mode='w') as f:
+    with open(path.join(files_directory, ASPECTS_FILE_NAME), mode='w') as f:
         for i in numeric:
             if i == Aspect.HUMAN.value:
                 f.write(Aspect.HUMAN.name)
@@ -671,7 +1875,7 @@ def read_aspect_values_from_file() -> Dict[Aspect, int]:
         value_dict[aspect.opposite()] = -value
 
     value = 25
-    with open('files/'+ASPECTS_FILE_NAME, mode='r') as f:
+    with open(path.join(files_directory, ASPECTS_FILE_NAME), mode='r') as f:
         for line in f:
             line = line.strip()
             if line == Aspect.HUMAN.name:
@@ -699,7 +1903,7 @@ def read_aspect_values_from_file() -> Dict[Aspect, int]:
 
 
 def read_or_rank_aspect_values() -> Dict[Aspect, int]:
-    if not path.exists('files/' + ASPECTS_FILE_NAME):
+    if not path.exists(path.join(files_directory, ASPECTS_FILE_NAME)):
         rank_aspect_values()
 
     try:
@@ -732,26 +1936,26 @@ def get_new_action() -> bool:
             if manhunt is None:
                 continue
             else:
-                actions.put(manhunt)
+                queue_action(manhunt)
         elif user_in == 2:
             grotto = take_grotto_input()
             if grotto is None:
                 continue
             else:
-                actions.put(grotto)
+                queue_action(grotto)
         elif user_in == 3:
-            actions.put(take_tavern_input())
+            queue_action(take_tavern_input())
         elif user_in == 4:
-            actions.put(take_graveyard_input())
+            queue_action(take_graveyard_input())
         elif user_in == 5:
-            actions.put(HealAction())
+            queue_action(HealAction())
 
         return True
 
 
 def take_manhunt_input():
     while 1:
-        target = input('  1) Farm   2) Village   3) Small Town   4) City   5) Metropolis   0) Cancel\n'
+        target = input('  1) Farm   2) Village   3) Small Town   4) City   5) Metropolis   6) Auto   0) Cancel\n'
                       '  Choose category: ').strip()
 
         if not target.isnumeric():
@@ -759,7 +1963,7 @@ def take_manhunt_input():
             continue
 
         target = int(target)
-        if target > 5:
+        if target > 6:
             print('  Invalid input\n')
             continue
 
@@ -776,12 +1980,12 @@ def take_manhunt_input():
             print()
             return None
 
-        return ManHuntAction(ManHuntTarget(target), int(amount))
+        return ManHuntAction(ManHuntTarget(target) if target != 6 else None, int(amount))
 
 
 def take_grotto_input():
     while 1:
-        difficulty = input('  1) {}   2) {}   3) {}   0) Cancel\n' 
+        difficulty = input('  1) {}   2) {}   3) {}   4) Auto   0) Cancel\n' 
                            '  Choose difficulty: '.format(Difficulty.EASY.name, Difficulty.MEDIUM.name,
                                                           Difficulty.DIFFICULT.name)).strip()
         if not difficulty.isnumeric():
@@ -789,7 +1993,7 @@ def take_grotto_input():
             continue
 
         difficulty = int(difficulty)
-        if difficulty > 3:
+        if difficulty > 4:
             print('  Invalid input\n')
             continue
 
@@ -806,7 +2010,7 @@ def take_grotto_input():
             print()
             return None
 
-        return GrottoAction(Difficulty(difficulty),int(amount))
+        return GrottoAction(Difficulty(difficulty) if difficulty != 4 else None,int(amount))
 
 
 def take_tavern_input():
@@ -831,22 +2035,144 @@ def take_graveyard_input():
         return GraveyardAction(int(amount))
 
 
+def parse_job_file(file_name: str) -> Result:
+    rules = []
+    with open(file_name) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                rules.append(parse_job_rule(line))
+            except (ValueError, KeyError, IndexError) as e:
+                return Err('Job file line {} is invalid ({}): {}'.format(number, e, line))
+
+    return Ok(rules)
+
+
+def parse_job_rule(line: str) -> JobRule:
+    words = line.split()
+    if words[0].lower() not in ('once', 'every'):
+        raise ValueError('rules start with "once" or "every"')
+
+    end = next((i for i in range(2, len(words)) if words[i].lower() in ('when', 'between')), len(words))
+    create_action = parse_job_action(words[1].lower(), words[2:end])
+
+    conditions = []
+    window = None
+    rest = words[end:]
+    while rest:
+        if rest[0].lower() == 'when' and len(rest) >= 4:
+            attribute = rest[1].lower()
+            if attribute not in ('ap', 'hp', 'gold') or rest[2] not in Condition.OPERATORS:
+                raise ValueError('conditions look like "when AP >= 10"')
+            conditions.append(Condition(attribute, rest[2], int(rest[3])))
+            rest = rest[4:]
+        elif rest[0].lower() == 'between' and len(rest) >= 3:
+            window = TimeWindow(clock_time.fromisoformat(rest[1]), clock_time.fromisoformat(rest[2]))
+            rest = rest[3:]
+        else:
+            raise ValueError('unexpected "{}"'.format(' '.join(rest)))
+
+    return JobRule(line, words[0].lower() == 'every', create_action, conditions, window)
+
+
+def parse_job_action(name: str, args: List[str]) -> Callable[[], Action]:
+    if name not in JOB_ACTION_ARGUMENTS:
+        raise ValueError('unknown action "{}"'.format(name))
+    if len(args) != JOB_ACTION_ARGUMENTS[name]:
+        raise ValueError('"{}" takes {} arguments, got "{}"'.format(name, JOB_ACTION_ARGUMENTS[name], ' '.join(args)))
+
+    if name == 'manhunt':
+        target = None if args[0].upper() == 'AUTO' else ManHuntTarget[args[0].upper()]
+        amount = parse_job_amount(args[1])
+        return lambda: ManHuntAction(target, amount)
+    elif name == 'grotto':
+        difficulty = None if args[0].upper() == 'AUTO' else Difficulty[args[0].upper()]
+        amount = parse_job_amount(args[1])
+        return lambda: GrottoAction(difficulty, amount)
+    elif name == 'tavern':
+        amount = parse_job_amount(args[0])
+        return lambda: TavernAction(amount)
+    elif name == 'graveyard':
+        amount = parse_job_amount(args[0])
+        return lambda: GraveyardAction(amount)
+    else:
+        return lambda: HealAction()
+
+
+def parse_job_amount(text: str) -> int:
+    amount = int(text)
+    if amount < 1:
+        raise ValueError('amounts must be at least 1')
+
+    return amount
+
+
+def get_status_bar_lines() -> List[str]:
+    return split_status_bar(get_text_excluding_children(driver.find_element_by_class_name('gold')))
+
+
+def split_status_bar(upper_bar_text: str) -> List[str]:
+    return upper_bar_text.strip().split('\n')
+
+
+def get_player_status() -> PlayerStatus:
+    lines = get_status_bar_lines()
+    status = PlayerStatus(parse_gold(lines), parse_AP(lines), parse_HP(lines))
+    publish_status(status)
+    return status
+
+
+def publish_status(status: PlayerStatus):
+    player_ap.set(status.ap)
+    player_hp.set(status.hp)
+    player_gold.set(status.gold)
+
+
 def get_HP() -> int:
-    upper_bar_text = get_text_excluding_children(driver.find_element_by_class_name('gold'))
-    hp_text:str = upper_bar_text.strip().split('\n')[4].strip()
+    return parse_HP(get_status_bar_lines())
+
+
+def get_AP() -> int:
+    return parse_AP(get_status_bar_lines())
+
+
+def get_gold() -> int:
+    return parse_gold(get_status_bar_lines())
+
+
+def parse_HP(lines: List[str]) -> int:
+    hp_text:str = lines[4].strip()
     hp = hp_text[0 : hp_text.find('/')]
     hp = hp.replace('.','')
 
     return int(hp)
 
 
-def get_AP() -> int:
-    upper_bar_text = get_text_excluding_children(driver.find_element_by_class_name('gold'))
-    ap_text: str = upper_bar_text.strip().split('\n')[3].strip()
+def parse_AP(lines: List[str]) -> int:
+    ap_text: str = lines[3].strip()
     ap = ap_text[0: ap_text.find('/')]
 
     return int(ap)
 
+
+def parse_gold(lines: List[str]) -> int:
+    return int(lines[0].strip().replace('.',''))
+
+
+def get_report_experience() -> int:
+    reports = driver.find_elements_by_id(REPORT_ELEMENT_ID)
+    if not reports:
+        return 0
+
+    match = EXPERIENCE_PATTERN.search(reports[0].text)
+    if match is None:
+        return 0
+
+    return int(match.group(1).replace('.',''))
+
 def get_text_excluding_children(element):
     return driver.execute_script("""
     return jQuery(arguments[0]).contents().filter(function() {
@@ -861,9 +2187,9 @@ def fill_input(_input: WebElement, text: str):
 
 
 def click(element: WebElement):
-    sleep(CLICK_DELAY)
+    clock.sleep(CLICK_DELAY)
     element.click()
 
 
 if __name__ == '__main__':
-    run()
+    run(parse_arguments())
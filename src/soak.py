@@ -0,0 +1,273 @@
+import random
+import tracemalloc
+import argparse
+
+from os import path, remove
+from pathlib import Path
+from threading import Event
+from time import time
+from typing import List, Callable
+
+import main
+from main import ManHuntTarget, Difficulty, Aspect, VirtualClock, OutcomeLedger, JobFile, JobPlanner, \
+    PAGE_LOAD_COMMANDS, REPORT_ELEMENT_ID, LEDGER_FILE_NAME, webdriver_commands, get_manhunt_target_cost, \
+    create_action_repository, instrument_driver, execute_actions
+
+
+class MockElement:
+    def __init__(self, mock_driver: 'MockGameDriver', text: str = '', on_click: Callable[[], None] = lambda: None):
+        self.mock_driver = mock_driver
+        self.text = text
+        self.on_click = on_click
+
+    def click(self):
+        self.mock_driver.execute('clickElement', {'element': self})
+
+    def find_element_by_xpath(self, xpath: str):
+        return self
+
+
+# Stands in for the game in soak tests. It answers the handful of lookups the actions make and keeps a simple
+# game state (AP and HP that regenerate over time, gold) driven by the clicks.
+class MockGameDriver:
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+        self.gold = 0
+        self.ap = MOCK_MAX_AP
+        self.hp = float(MOCK_MAX_HP)
+        self.ap_regenerated = main.clock.time()
+        self.hp_regenerated = main.clock.time()
+        self.experience = 0
+        self.target = ManHuntTarget.FARM
+
+    def execute(self, driver_command: str, params=None):
+        main.clock.sleep(MOCK_PAGE_LATENCY if driver_command in PAGE_LOAD_COMMANDS else MOCK_COMMAND_LATENCY)
+        if driver_command == 'clickElement':
+            params['element'].on_click()
+        return {'value': None}
+
+    def get(self, url: str):
+        self.execute('get', {'url': url})
+
+    def quit(self):
+        pass
+
+    def execute_script(self, script: str, *args):
+        self.execute('executeScript')
+        if 'usedJSHeapSize' in script:
+            return tracemalloc.get_traced_memory()[0]
+
+        self.__regenerate()
+        return '{}\n0\n0\n{}/{}\n{}/{}'.format(self.gold, self.ap, MOCK_MAX_AP, int(self.hp), MOCK_MAX_HP)
+
+    def find_element_by_link_text(self, text: str) -> MockElement:
+        self.execute('findElement')
+        return MockElement(self, text, lambda: self.__tavern_choice())
+
+    def find_element_by_class_name(self, name: str) -> MockElement:
+        self.execute('findElement')
+        if name == 'btn-right':
+            return MockElement(self, on_click=lambda: self.__spend(3))
+        return MockElement(self)
+
+    def find_elements_by_class_name(self, name: str) -> List[MockElement]:
+        self.execute('findElements')
+        if name == 'mjs':
+            return [MockElement(self, on_click=lambda t=target: self.__hunt(t)) for target in ManHuntTarget]
+        elif name == 'btn':
+            choices = self.random.sample(MOCK_TAVERN_CHOICES, 2)
+            return [MockElement(self), MockElement(self, choices[0], lambda: self.__spend(3)),
+                    MockElement(self, choices[1])]
+        elif name == 'buttonOverlay':
+            return [MockElement(self)]
+        return []
+
+    def find_element_by_xpath(self, xpath: str) -> MockElement:
+        self.execute('findElement')
+        if 'Again' in xpath:
+            return MockElement(self, on_click=lambda: self.__hunt(self.target))
+        return MockElement(self)
+
+    def find_element_by_name(self, name: str) -> MockElement:
+        self.execute('findElement')
+        if name == 'dowork':
+            return MockElement(self, on_click=lambda: self.__work())
+        elif name == 'heal':
+            return MockElement(self, on_click=lambda: self.__heal())
+        return MockElement(self)
+
+    def find_elements_by_name(self, name: str) -> List[MockElement]:
+        self.execute('findElements')
+        return [MockElement(self, on_click=lambda d=difficulty: self.__fight(d)) for difficulty in Difficulty]
+
+    def find_elements_by_id(self, element_id: str) -> List[MockElement]:
+        self.execute('findElements')
+        if element_id == REPORT_ELEMENT_ID:
+            return [MockElement(self, 'You receive {} experience'.format(self.experience))]
+        return []
+
+    def __regenerate(self):
+        now = main.clock.time()
+        self.hp = min(MOCK_MAX_HP, self.hp + (now - self.hp_regenerated) * MOCK_HP_PER_SECOND)
+        self.hp_regenerated = now
+
+        points = int((now - self.ap_regenerated) / MOCK_AP_INTERVAL)
+        self.ap = min(MOCK_MAX_AP, self.ap + points)
+        self.ap_regenerated = now if self.ap == MOCK_MAX_AP else self.ap_regenerated + points * MOCK_AP_INTERVAL
+
+    def __spend(self, ap: int) -> bool:
+        self.__regenerate()
+        if self.ap < ap:
+            return False
+        self.ap -= ap
+        return True
+
+    def __hunt(self, target: ManHuntTarget):
+        self.target = target
+        self.experience = 0
+        if self.__spend(get_manhunt_target_cost(target)):
+            self.gold += int(self.random.randint(10, 30) * MOCK_HUNT_GOLD_FACTORS[int(target) - 1])
+            self.experience = int(target) * self.random.randint(1, 3)
+
+    def __fight(self, difficulty: Difficulty):
+        self.experience = 0
+        if self.__spend(1):
+            self.hp -= self.random.randint(200, 400) * int(difficulty)
+            self.gold += self.random.randint(20, 60) * int(difficulty)
+            self.experience = 2 * int(difficulty)
+
+    def __work(self):
+        self.gold += 100
+
+    def __heal(self):
+        if self.__spend(MOCK_HEAL_AP):
+            self.hp = MOCK_MAX_HP
+
+    def __tavern_choice(self):
+        self.hp -= self.random.randint(0, 20)
+
+
+class SoakSample:
+    def __init__(self, hour: int, actions_done: int, commands: float, latencies: List[float], memory: int):
+        self.hour = hour
+        self.actions_done = actions_done
+        self.commands = commands
+        self.mean_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        self.max_latency = max(latencies) if latencies else 0.0
+        self.memory = memory
+
+
+class SoakRecorder:
+    def __init__(self, start: float, duration: float):
+        self.end = start + duration
+        self.interval_end = start + SOAK_SAMPLE_INTERVAL
+        self.samples: List[SoakSample] = []
+        self.actions_done = 0
+        self.latencies: List[float] = []
+        self.commands = webdriver_commands.total()
+
+    def finished(self) -> bool:
+        return main.clock.time() >= self.end
+
+    def record(self, queue_latency: float):
+        self.actions_done += 1
+        self.latencies.append(queue_latency)
+
+    def tick(self):
+        while main.clock.time() >= self.interval_end:
+            commands = webdriver_commands.total()
+            self.samples.append(SoakSample(len(self.samples) + 1, self.actions_done, commands - self.commands,
+                                           self.latencies, tracemalloc.get_traced_memory()[0]))
+            self.actions_done = 0
+            self.latencies = []
+            self.commands = commands
+            self.interval_end += SOAK_SAMPLE_INTERVAL
+
+    def report(self) -> str:
+        lines = ['{:>6}{:>10}{:>12}{:>16}{:>16}{:>14}'.format('hour', 'actions', 'commands', 'avg wait (s)',
+                                                            'max wait (s)', 'memory (KiB)')]
+        for sample in self.samples:
+            lines.append('{:>6}{:>10}{:>12.0f}{:>16.1f}{:>16.1f}{:>14.0f}'.format(
+                sample.hour, sample.actions_done, sample.commands, sample.mean_latency, sample.max_latency,
+                sample.memory / 1024))
+
+        if self.samples:
+            first = self.samples[0]
+            last = self.samples[-1]
+            lines.append('Throughput drift: {:.0f} commands in hour {}, {:.0f} in hour {}'
+                         .format(first.commands, first.hour, last.commands, last.hour))
+            lines.append('Memory growth: {:.0f} KiB to {:.0f} KiB'.format(first.memory / 1024, last.memory / 1024))
+            lines.append('Longest wait from a job becoming due to its start: {:.1f} s'
+                         .format(max(sample.max_latency for sample in self.samples)))
+
+        return '\n'.join(lines)
+
+
+
+SOAK_DIRECTORY_NAME = 'soak'
+SOAK_REPORT_FILE_NAME = 'report.txt'
+SOAK_SAMPLE_INTERVAL = 3600
+MOCK_MAX_AP = 100
+MOCK_MAX_HP = 12000
+MOCK_AP_INTERVAL = 240
+MOCK_HP_PER_SECOND = 1.5
+MOCK_HEAL_AP = 5
+MOCK_COMMAND_LATENCY = 0.02
+MOCK_PAGE_LATENCY = 0.4
+MOCK_HUNT_GOLD_FACTORS = [1.0, 1.3, 2.2, 2.6, 4.0]
+MOCK_TAVERN_CHOICES = ['Examine', 'Rob', 'Hide', 'Talk', 'Snoop', 'Party', 'Carry on walking', 'Stay here']
+
+
+
+# Soak tests play the job file against MockGameDriver instead of the real game. They swap main's clock for a
+# VirtualClock and main's driver for the mock, then run main's own executor and planner unchanged.
+def run_soak_test(arguments):
+    main.files_directory = arguments.files_dir
+    soak_directory = path.join(main.files_directory, SOAK_DIRECTORY_NAME)
+    Path(soak_directory).mkdir(parents=True, exist_ok=True)
+    ledger_file = path.join(soak_directory, LEDGER_FILE_NAME.format(0, 'soak'))
+    if path.exists(ledger_file):
+        remove(ledger_file)
+
+    main.clock = VirtualClock(time())
+    main.ledger = OutcomeLedger(ledger_file)
+    main.aspect_value_dict = {aspect: 0 for aspect in Aspect}
+    main.actionRepository = create_action_repository()
+    main.driver = MockGameDriver(arguments.seed)
+    instrument_driver(main.driver)
+
+    job_file = JobFile(arguments.jobs)
+    load_result = job_file.reload_if_changed()
+    if load_result.is_err():
+        print(load_result.value)
+        print('Terminating.')
+        return
+
+    print('Simulating {} hours with {} job rules...'.format(arguments.hours, len(job_file.rules)))
+    tracemalloc.start()
+    started = time()
+    recorder = SoakRecorder(main.clock.time(), arguments.hours * 3600)
+    execute_actions(Event(), JobPlanner(job_file), metrics_file=arguments.metrics_file, recorder=recorder)
+    recorder.tick()
+    tracemalloc.stop()
+
+    report = recorder.report() + '\nSimulated {} hours in {:.0f} seconds.\n'.format(arguments.hours, time() - started)
+    with open(path.join(soak_directory, SOAK_REPORT_FILE_NAME), mode='w') as f:
+        f.write(report)
+    print('\n' + report)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Simulates unattended play of a job file against a mock game.')
+    parser.add_argument('hours', type=float, help='simulated hours to play')
+    parser.add_argument('--jobs', metavar='FILE', required=True, help='job file deciding what to do')
+    parser.add_argument('--files-dir', metavar='DIR', default='files',
+                        help='directory the soak folder with the report and ledger is created in (default: files)')
+    parser.add_argument('--seed', metavar='N', type=int, default=1, help='random seed of the mock game (default: 1)')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='write the metrics to FILE after every action and on exit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    run_soak_test(parse_arguments())